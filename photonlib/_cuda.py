@@ -0,0 +1,276 @@
+'''
+Fused CUDA kernels for the voxel conversions in VoxelMeta.
+
+The extension is compiled on first use with torch.utils.cpp_extension.load_inline,
+so it requires nvcc at runtime and the first CUDA call blocks until the build
+(or a lookup in the torch extension cache) has finished. Use load() to obtain the
+compiled module, or None if it cannot be built on this machine.
+'''
+import torch
+import warnings
+
+_CPP_SOURCE = '''
+torch::Tensor coord_to_voxel(torch::Tensor coord,
+                             std::vector<double> mn,
+                             std::vector<double> inv_step,
+                             std::vector<int64_t> shape);
+
+torch::Tensor coord_to_voxel_soa(torch::Tensor x,
+                                 torch::Tensor y,
+                                 torch::Tensor z,
+                                 std::vector<double> mn,
+                                 std::vector<double> inv_step,
+                                 std::vector<int64_t> shape);
+
+torch::Tensor voxel_to_idx(torch::Tensor voxel,
+                           std::vector<int64_t> fdm_nx,
+                           std::vector<int64_t> fdm_ny);
+'''
+
+_CUDA_SOURCE = '''
+#include <torch/extension.h>
+#include <c10/cuda/CUDAStream.h>
+#include <c10/cuda/CUDAGuard.h>
+#include <c10/cuda/CUDAException.h>
+
+// Integer division by a runtime constant using a precomputed magic number
+// (Granlund-Montgomery, as in onnxruntime's fast_divmod). Valid for 0 <= n < 2^31.
+struct FastDivmod {
+    int d;
+    uint32_t m;
+    int s;
+
+    __device__ __forceinline__ void divmod(int n, int& q, int& r) const {
+        uint32_t t = __umulhi(m, (uint32_t)n);
+        q = (int)((t + (uint32_t)n) >> s);
+        r = n - q * d;
+    }
+};
+
+// floor division and the matching non-negative remainder (torch's rounding_mode='floor')
+__device__ __forceinline__ void floor_divmod(int64_t n, int64_t d, int64_t& q, int64_t& r) {
+    q = n / d;
+    r = n - q * d;
+    if (r < 0) {
+        q -= 1;
+        r += d;
+    }
+}
+
+__device__ __forceinline__ int64_t point_to_voxel(float x, float y, float z,
+                                          float3 mn, float3 inv_step, int3 shape)
+{
+    int ix = __float2int_rd((x - mn.x) * inv_step.x);
+    int iy = __float2int_rd((y - mn.y) * inv_step.y);
+    int iz = __float2int_rd((z - mn.z) * inv_step.z);
+
+    ix = max(0, min(ix, shape.x - 1));
+    iy = max(0, min(iy, shape.y - 1));
+    iz = max(0, min(iz, shape.z - 1));
+
+    return (int64_t)ix + (int64_t)iy * shape.x + (int64_t)iz * shape.x * shape.y;
+}
+
+__global__ void coord_to_voxel_kernel(const float3* __restrict__ coord,
+                                      float3 mn, float3 inv_step, int3 shape,
+                                      int64_t* __restrict__ out, int64_t N)
+{
+    int64_t idx = (int64_t)blockIdx.x * blockDim.x + threadIdx.x;
+    if (idx >= N) return;
+
+    const float3 c = coord[idx];
+    out[idx] = point_to_voxel(c.x, c.y, c.z, mn, inv_step, shape);
+}
+
+// same as coord_to_voxel_kernel for x, y, z stored as separate arrays (coalesced loads)
+__global__ void coord_to_voxel_soa_kernel(const float* __restrict__ x,
+                                          const float* __restrict__ y,
+                                          const float* __restrict__ z,
+                                          float3 mn, float3 inv_step, int3 shape,
+                                          int64_t* __restrict__ out, int64_t N)
+{
+    int64_t idx = (int64_t)blockIdx.x * blockDim.x + threadIdx.x;
+    if (idx >= N) return;
+
+    out[idx] = point_to_voxel(x[idx], y[idx], z[idx], mn, inv_step, shape);
+}
+
+torch::Tensor coord_to_voxel(torch::Tensor coord,
+                             std::vector<double> mn,
+                             std::vector<double> inv_step,
+                             std::vector<int64_t> shape)
+{
+    TORCH_CHECK(coord.is_cuda(), "coord must be a CUDA tensor");
+    TORCH_CHECK(coord.scalar_type() == torch::kFloat32, "coord must be float32");
+    TORCH_CHECK(coord.dim() == 2 && coord.size(1) == 3, "coord must have shape (N,3)");
+
+    const c10::cuda::OptionalCUDAGuard guard(device_of(coord));
+    coord = coord.contiguous();
+    const int64_t N = coord.size(0);
+    auto out = torch::empty({N}, coord.options().dtype(torch::kInt64));
+    if (N == 0) return out;
+
+    const int block = 256;
+    const int64_t grid = (N + block - 1) / block;
+    auto stream = c10::cuda::getCurrentCUDAStream();
+
+    coord_to_voxel_kernel<<<grid, block, 0, stream>>>(
+        reinterpret_cast<const float3*>(coord.data_ptr<float>()),
+        make_float3(mn[0], mn[1], mn[2]),
+        make_float3(inv_step[0], inv_step[1], inv_step[2]),
+        make_int3(shape[0], shape[1], shape[2]),
+        out.data_ptr<int64_t>(),
+        N);
+    C10_CUDA_KERNEL_LAUNCH_CHECK();
+
+    return out;
+}
+
+torch::Tensor coord_to_voxel_soa(torch::Tensor x,
+                                 torch::Tensor y,
+                                 torch::Tensor z,
+                                 std::vector<double> mn,
+                                 std::vector<double> inv_step,
+                                 std::vector<int64_t> shape)
+{
+    for (const auto& t : {x, y, z}) {
+        TORCH_CHECK(t.is_cuda(), "x, y, z must be CUDA tensors");
+        TORCH_CHECK(t.scalar_type() == torch::kFloat32, "x, y, z must be float32");
+        TORCH_CHECK(t.dim() == 1 && t.size(0) == x.size(0), "x, y, z must be 1D with the same length");
+        TORCH_CHECK(t.device() == x.device(), "x, y, z must be on the same device");
+    }
+
+    const c10::cuda::OptionalCUDAGuard guard(device_of(x));
+
+    x = x.contiguous();
+    y = y.contiguous();
+    z = z.contiguous();
+    const int64_t N = x.size(0);
+    auto out = torch::empty({N}, x.options().dtype(torch::kInt64));
+    if (N == 0) return out;
+
+    const int block = 256;
+    const int64_t grid = (N + block - 1) / block;
+    auto stream = c10::cuda::getCurrentCUDAStream();
+
+    coord_to_voxel_soa_kernel<<<grid, block, 0, stream>>>(
+        x.data_ptr<float>(), y.data_ptr<float>(), z.data_ptr<float>(),
+        make_float3(mn[0], mn[1], mn[2]),
+        make_float3(inv_step[0], inv_step[1], inv_step[2]),
+        make_int3(shape[0], shape[1], shape[2]),
+        out.data_ptr<int64_t>(),
+        N);
+    C10_CUDA_KERNEL_LAUNCH_CHECK();
+
+    return out;
+}
+
+__global__ void voxel_to_idx_kernel(const int64_t* __restrict__ voxel,
+                                    FastDivmod fdm_nx, FastDivmod fdm_ny,
+                                    int64_t* __restrict__ out, int64_t N)
+{
+    int64_t idx = (int64_t)blockIdx.x * blockDim.x + threadIdx.x;
+    if (idx >= N) return;
+
+    const int64_t v = voxel[idx];
+
+    if (v >= 0 && v <= INT_MAX) {
+        int q, ix, iy, iz;
+        fdm_nx.divmod((int)v, q, ix);
+        fdm_ny.divmod(q, iz, iy);
+
+        out[idx*3 + 0] = ix;
+        out[idx*3 + 1] = iy;
+        out[idx*3 + 2] = iz;
+    } else {
+        // outside the fast_divmod range (invalid IDs): follow the torch path exactly
+        int64_t q, ix, iy, iz;
+        floor_divmod(v, fdm_nx.d, q, ix);
+        floor_divmod(q, fdm_ny.d, iz, iy);
+
+        out[idx*3 + 0] = ix;
+        out[idx*3 + 1] = iy;
+        out[idx*3 + 2] = iz;
+    }
+}
+
+torch::Tensor voxel_to_idx(torch::Tensor voxel,
+                           std::vector<int64_t> fdm_nx,
+                           std::vector<int64_t> fdm_ny)
+{
+    TORCH_CHECK(voxel.is_cuda(), "voxel must be a CUDA tensor");
+    TORCH_CHECK(voxel.scalar_type() == torch::kInt64, "voxel must be int64");
+
+    const c10::cuda::OptionalCUDAGuard guard(device_of(voxel));
+    voxel = voxel.contiguous().view({-1});
+    const int64_t N = voxel.size(0);
+    auto out = torch::empty({N, 3}, voxel.options());
+    if (N == 0) return out;
+
+    FastDivmod nx{(int)fdm_nx[0], (uint32_t)fdm_nx[1], (int)fdm_nx[2]};
+    FastDivmod ny{(int)fdm_ny[0], (uint32_t)fdm_ny[1], (int)fdm_ny[2]};
+
+    const int block = 256;
+    const int64_t grid = (N + block - 1) / block;
+    auto stream = c10::cuda::getCurrentCUDAStream();
+
+    voxel_to_idx_kernel<<<grid, block, 0, stream>>>(
+        voxel.data_ptr<int64_t>(), nx, ny, out.data_ptr<int64_t>(), N);
+    C10_CUDA_KERNEL_LAUNCH_CHECK();
+
+    return out;
+}
+'''
+
+
+def fast_divmod_params(d):
+    '''
+    Host-side setup of the FastDivmod struct used by the kernels
+
+    Parameters
+    ----------
+    d : int
+        The (positive) divisor
+
+    Returns
+    -------
+    tuple
+        (divisor, magic multiplier, shift)
+    '''
+    d = int(d)
+    if not 0 < d < 2**31:
+        raise ValueError(f'divisor must be in (0, 2**31), got {d}')
+
+    s = 0
+    while (1 << s) < d:
+        s += 1
+    m = ((1 << 32) * ((1 << s) - d)) // d + 1
+
+    return d, m & 0xFFFFFFFF, s
+
+
+def load():
+    '''
+    Compile (or fetch from the torch extension cache) the CUDA extension
+
+    Returns
+    -------
+    module or None
+        The compiled extension, or None if CUDA or the toolchain is unavailable.
+    '''
+    if not torch.cuda.is_available():
+        return None
+
+    from torch.utils.cpp_extension import load_inline
+    print('[VoxelMeta] loading the CUDA extension (compiled with nvcc on first use, may take a while)')
+    try:
+        return load_inline(
+            name='photonlib_cuda',
+            cpp_sources=_CPP_SOURCE,
+            cuda_sources=_CUDA_SOURCE,
+            functions=['coord_to_voxel', 'coord_to_voxel_soa', 'voxel_to_idx'],
+            extra_cuda_cflags=['-O3'],
+        )
+    except (RuntimeError, OSError) as e:
+        warnings.warn(f'CUDA extension unavailable, using torch fallback ({e})')
+        return None
@@ -0,0 +1,31 @@
+'''
+Numba-compiled CPU kernels for the voxel conversions in VoxelMeta.
+
+numba is an optional dependency; this module is imported lazily by VoxelMeta.
+'''
+from numba import njit, prange
+
+
+@njit(inline='always')
+def _axis_index(x, n):
+    '''
+    Clamp the (fractional) index x to [0, n-1] in floating point before truncating,
+    as VoxelMeta does in torch. NaN fails the comparison and maps to 0.
+    '''
+    if x >= n - 1:
+        return n - 1
+    if x > 0:
+        return int(x)
+    return 0
+
+
+@njit(parallel=True, cache=True)
+def coord_to_voxel_np(coord, mn, inv_step, nx, ny, nz, out):
+    '''
+    Fill out (N) with the voxel IDs of the (N,3) absolute positions in coord
+    '''
+    for i in prange(coord.shape[0]):
+        ix = _axis_index((coord[i,0] - mn[0]) * inv_step[0], nx)
+        iy = _axis_index((coord[i,1] - mn[1]) * inv_step[1], ny)
+        iz = _axis_index((coord[i,2] - mn[2]) * inv_step[2], nz)
+        out[i] = ix + iy*nx + iz*nx*ny
@@ -0,0 +1,123 @@
+'''
+Triton kernels for the voxel conversions in VoxelMeta.
+
+A portable GPU alternative (e.g. for ROCm) to the CUDA extension in _cuda.py that
+does not need a C++/CUDA toolchain. triton is an optional dependency; this module
+is imported lazily by VoxelMeta.
+'''
+import torch
+import triton
+import triton.language as tl
+
+BLOCK = 1024
+
+
+@triton.jit
+def _axis_index(c, mn, inv_step, n):
+    # clamp in floating point before the cast (as VoxelMeta does in torch and numba):
+    # float to int conversion of NaN, inf or out-of-range values is undefined
+    x = (c - mn) * inv_step
+    x = tl.where(x == x, x, 0.)
+    x = tl.minimum(tl.maximum(x, 0.), (n - 1).to(tl.float32))
+    return x.to(tl.int64)
+
+
+@triton.jit
+def _c2v_kernel(coord_ptr, out_ptr,
+                mn0, mn1, mn2, is0, is1, is2,
+                nx, ny, nz, N,
+                BLOCK: tl.constexpr):
+    pid = tl.program_id(0)
+    offs = pid * BLOCK + tl.arange(0, BLOCK)
+    mask = offs < N
+
+    # load the (BLOCK,3) tile in one go (padded to 4 features) then split the axes
+    cols = tl.arange(0, 4)
+    tile = tl.load(coord_ptr + offs[:, None] * 3 + cols[None, :],
+                   mask=mask[:, None] & (cols[None, :] < 3), other=0.)
+    c0 = tl.sum(tl.where(cols[None, :] == 0, tile, 0.), axis=1)
+    c1 = tl.sum(tl.where(cols[None, :] == 1, tile, 0.), axis=1)
+    c2 = tl.sum(tl.where(cols[None, :] == 2, tile, 0.), axis=1)
+
+    ix = _axis_index(c0, mn0, is0, nx)
+    iy = _axis_index(c1, mn1, is1, ny)
+    iz = _axis_index(c2, mn2, is2, nz)
+
+    vox = ix + iy * nx + iz * nx * ny
+    tl.store(out_ptr + offs, vox, mask=mask)
+
+
+@triton.jit
+def _c2v_soa_kernel(x_ptr, y_ptr, z_ptr, out_ptr,
+                    mn0, mn1, mn2, is0, is1, is2,
+                    nx, ny, nz, N,
+                    BLOCK: tl.constexpr):
+    pid = tl.program_id(0)
+    offs = pid * BLOCK + tl.arange(0, BLOCK)
+    mask = offs < N
+
+    c0 = tl.load(x_ptr + offs, mask=mask, other=0.)
+    c1 = tl.load(y_ptr + offs, mask=mask, other=0.)
+    c2 = tl.load(z_ptr + offs, mask=mask, other=0.)
+
+    ix = _axis_index(c0, mn0, is0, nx)
+    iy = _axis_index(c1, mn1, is1, ny)
+    iz = _axis_index(c2, mn2, is2, nz)
+
+    vox = ix + iy * nx + iz * nx * ny
+    tl.store(out_ptr + offs, vox, mask=mask)
+
+
+def coord_to_voxel(coord, mn, inv_step, shape):
+    '''
+    Compute the voxel IDs of the (N,3) absolute positions in coord
+
+    Parameters
+    ----------
+    coord : torch.Tensor
+        (N,3) positions on a GPU
+    mn : sequence of float
+        The minimum point of the volume
+    inv_step : sequence of float
+        The inverse voxel size along each axis
+    shape : sequence of int
+        The voxel count along each axis
+
+    Returns
+    -------
+    torch.Tensor
+        (N) int64 voxel IDs
+    '''
+    coord = coord.contiguous()
+    N = coord.shape[0]
+    out = torch.empty(N, dtype=torch.int64, device=coord.device)
+    if N == 0:
+        return out
+
+    # triton launches on the current device, so make it the tensor's device
+    grid = (triton.cdiv(N, BLOCK),)
+    with torch.cuda.device(coord.device):
+        _c2v_kernel[grid](coord, out, *mn, *inv_step, *shape, N, BLOCK=BLOCK)
+    return out
+
+
+def coord_to_voxel_soa(x, y, z, mn, inv_step, shape):
+    '''
+    Same as coord_to_voxel for positions given as three 1D tensors x, y, z
+    '''
+    for v in (y, z):
+        if v.dim() != 1 or x.dim() != 1 or len(v) != len(x):
+            raise ValueError(f'x, y, z must be 1D with the same length, got {x.shape}, {y.shape}, {z.shape}')
+        if v.device != x.device or v.dtype != x.dtype:
+            raise ValueError('x, y, z must have the same device and dtype')
+
+    x, y, z = x.contiguous(), y.contiguous(), z.contiguous()
+    N = x.shape[0]
+    out = torch.empty(N, dtype=torch.int64, device=x.device)
+    if N == 0:
+        return out
+
+    grid = (triton.cdiv(N, BLOCK),)
+    with torch.cuda.device(x.device):
+        _c2v_soa_kernel[grid](x, y, z, out, *mn, *inv_step, *shape, N, BLOCK=BLOCK)
+    return out
@@ -1,10 +1,33 @@
 import h5py
 import torch
+import warnings
 import numpy as np
 
+from functools import cached_property
 from tqdm import tqdm
 from contextlib import contextmanager
 
+from . import _cuda
+
+# options for opening photon library files for reading
+_H5_READ_KWARGS = dict(rdcc_nbytes=16*1024*1024, libver='latest')
+
+
+def _c2v_core(coord, *, mn, inv_step, nx, ny, nz, dtype):
+    '''
+    Fused absolute coordinate to voxel ID conversion (see VoxelMeta.coord_to_voxel).
+    Written as a pure chain of elementwise ops so that it compiles into a single kernel.
+    The volume definition is passed as python scalars rather than tensors. The index
+    arithmetic is done in dtype and the voxel IDs are returned as int64.
+    '''
+    # clamp in floating point before the cast; NaN goes to 0 like in the numba kernel
+    ix = ((coord[...,0] - mn[0]) * inv_step[0]).nan_to_num(0.).clamp(0, nx-1).to(dtype)
+    iy = ((coord[...,1] - mn[1]) * inv_step[1]).nan_to_num(0.).clamp(0, ny-1).to(dtype)
+    iz = ((coord[...,2] - mn[2]) * inv_step[2]).nan_to_num(0.).clamp(0, nz-1).to(dtype)
+
+    return (ix + iy*nx + iz*(nx*ny)).to(torch.int64)
+
+
 class AABox:
     '''
     Axis-Aligned bounding box in the N-dim cartesian coordinate
@@ -21,7 +44,42 @@ class AABox:
             The second point [1,:] is the maximum point of the bounding box.
         '''
         self._ranges = torch.as_tensor(ranges, dtype=torch.float32)
-        self._lengths = torch.diff(self._ranges).flatten()
+        self._lengths = self._ranges[:,1] - self._ranges[:,0]
+
+        # norm_coord(pos) = (pos - min) * norm_a - 1
+        self._norm_a = 2. / self._lengths
+
+        # per-device copies of the constant tensors, populated lazily
+        self._ranges_cache = {}
+        self._lengths_cache = {}
+        self._norm_a_cache = {}
+
+    @staticmethod
+    def _cached_on(cache, tensor, device):
+        '''
+        Return a copy of tensor on the device, transferring it only once per device
+        '''
+        t = cache.get(device)
+        if t is None:
+            # a non-blocking copy to the host could be read before it has completed
+            t = tensor.to(device, non_blocking=torch.device(device).type == 'cuda')
+            cache[device] = t
+        return t
+
+    def __getstate__(self):
+        '''
+        Pickle without the per-device copies (they may hold GPU tensors)
+        '''
+        return {k: ({} if k.endswith('_cache') else v) for k, v in self.__dict__.items()}
+
+    def _ranges_on(self, device):
+        return self._cached_on(self._ranges_cache, self._ranges, device)
+
+    def _lengths_on(self, device):
+        return self._cached_on(self._lengths_cache, self._lengths, device)
+
+    def _norm_a_on(self, device):
+        return self._cached_on(self._norm_a_cache, self._norm_a, device)
     
     @property
     def ranges(self):
@@ -52,16 +110,13 @@ class AABox:
             instance holding the positions in the normalized coordinate using the box
             definition (the range along each axis -1 to 1).
         '''
-        pos = torch.as_tensor(pos)
-
-        ranges = torch.as_tensor(self.ranges, device=pos.device)
-
-        norm_pos = pos - ranges[:,0]
-        norm_pos /= torch.as_tensor(self.lengths, device=pos.device)
-        norm_pos *= 2.
-        norm_pos -= 1.
+        if not torch.is_tensor(pos):
+            pos = torch.as_tensor(pos, dtype=torch.float32)
 
-        return norm_pos
+        # subtract first (folding the offset into a single pos*a+b loses precision in
+        # float32 for boxes far from the origin), then scale and shift in place
+        norm_pos = pos - self._ranges_on(pos.device)[:,0]
+        return norm_pos.mul_(self._norm_a_on(pos.device)).sub_(1.)
 
 
     @classmethod
@@ -77,14 +132,19 @@ class AABox:
         else:
             raise TypeError('The argument must be a configuration dict or a filepath string')
 
-        with h5py.File(fname, 'r') as f:
-            ranges = torch.column_stack((
-                torch.as_tensor(f['min'],dtype=torch.float32),
-                torch.as_tensor(f['max'],dtype=torch.float32)
-                )
-            )
+        with h5py.File(fname, 'r', **_H5_READ_KWARGS) as f:
+            ranges = cls._read_ranges(f)
         return cls(ranges)
 
+    @staticmethod
+    def _read_ranges(f):
+        '''
+        Read the min/max points from an open photon library file into a (N,2) tensor
+        '''
+        mn = np.asarray(f['min'][()], dtype=np.float32)
+        mx = np.asarray(f['max'][()], dtype=np.float32)
+        return torch.from_numpy(np.stack([mn, mx], axis=1))
+
 
 
 class VoxelMeta(AABox):
@@ -100,6 +160,66 @@ class VoxelMeta(AABox):
     The attributes in this class provide ways to convert between these and the absolute coordinates.
     '''
 
+    # compiled CUDA extension shared by all instances (False = not loaded yet)
+    _cuda_ext = False
+
+    @classmethod
+    def cuda_ext(cls):
+        '''
+        Access the fused CUDA kernels, compiling them on the first call (this blocks
+        until nvcc has finished). Returns None if they cannot be built (e.g. no CUDA toolchain).
+        '''
+        if cls._cuda_ext is False:
+            VoxelMeta._cuda_ext = _cuda.load()
+        return cls._cuda_ext
+
+    # compiled _c2v_core shared by all instances, built on first use so that importing
+    # photonlib does not load torch._dynamo
+    _c2v_compiled = None
+
+    # set to False once torch.compile has failed so that coord_to_voxel stays eager
+    _c2v_compile_ok = True
+
+    # below this many coordinate values the eager torch path is used (not worth compiling)
+    _compile_min_numel = 3 * 2**14
+
+    # numba CPU kernels (False = not imported yet, None = numba unavailable)
+    _numba_ext = False
+
+    # below this many coordinate values the torch path is faster than numba
+    _numba_min_numel = 3 * 2**14
+
+    @classmethod
+    def numba_ext(cls):
+        '''
+        Access the numba CPU kernels, importing numba on the first call.
+        Returns None if numba is not installed.
+        '''
+        if cls._numba_ext is False:
+            try:
+                from . import _voxel_numba
+            except ImportError:
+                _voxel_numba = None
+            VoxelMeta._numba_ext = _voxel_numba
+        return cls._numba_ext
+
+    # triton GPU kernels (False = not imported yet, None = triton unavailable)
+    _triton_ext = False
+
+    @classmethod
+    def triton_ext(cls):
+        '''
+        Access the triton GPU kernels, importing triton on the first call.
+        Returns None if triton is not installed.
+        '''
+        if cls._triton_ext is False:
+            try:
+                from . import _voxel_triton
+            except ImportError:
+                _voxel_triton = None
+            VoxelMeta._triton_ext = _voxel_triton
+        return cls._triton_ext
+
     def __init__(self, shape, ranges):
         '''
         Constructor
@@ -113,7 +233,45 @@ class VoxelMeta(AABox):
         '''
         super().__init__(ranges)
         self._shape = torch.as_tensor(shape, dtype=torch.int64)
-        self._voxel_size = torch.diff(self.ranges).flatten() / self.shape
+        self._voxel_size = self._lengths / self._shape.to(torch.float32)
+        self._inv_voxel_size = torch.reciprocal(self._voxel_size)
+        self._nvoxels = int(torch.prod(self._shape).item())
+
+        # python scalar copies of the volume definition for scalar arithmetic and kernel arguments
+        self._xmin = tuple(self._ranges[:,0].tolist())
+        self._inv_step_f = tuple(self._inv_voxel_size.tolist())
+        self._n = tuple(self._shape.tolist())
+
+        # integer dtype for the per-axis index arithmetic inside _c2v_core: int32 unless
+        # the voxel count requires int64 (all public results are returned as int64)
+        self._index_dtype = torch.int32 if self._nvoxels < 2**31 else torch.int64
+
+        self._voxel_size_cache = {}
+        self._inv_voxel_size_cache = {}
+        self._shape_cache = {}
+
+        self._idx_max = self._shape - 1
+        self._idx_max_cache = {}
+
+        # voxel ID = idx . strides
+        self._voxel_strides = torch.tensor(
+            [1, int(self._shape[0]), int(self._shape[0]*self._shape[1])],
+            dtype=torch.int64,
+        )
+        self._voxel_strides_cache = {}
+
+        # magic numbers for the integer divisions in voxel_to_idx (CUDA kernel)
+        self._fdm_nx = _cuda.fast_divmod_params(self._shape[0])
+        self._fdm_ny = _cuda.fast_divmod_params(self._shape[1])
+
+        # volume definition passed to _c2v_core (plain python values, so picklable)
+        nx, ny, nz = self._n
+        self._c2v_kwargs = dict(
+            mn=self._xmin,
+            inv_step=self._inv_step_f,
+            nx=nx, ny=ny, nz=nz,
+            dtype=self._index_dtype,
+        )
        
     def __repr__(self):
         s = 'Meta'
@@ -124,7 +282,22 @@ class VoxelMeta(AABox):
         return s
 
     def __len__(self):
-        return torch.product(self.shape)
+        return self._nvoxels
+
+    def _voxel_size_on(self, device):
+        return self._cached_on(self._voxel_size_cache, self._voxel_size, device)
+
+    def _inv_voxel_size_on(self, device):
+        return self._cached_on(self._inv_voxel_size_cache, self._inv_voxel_size, device)
+
+    def _shape_on(self, device):
+        return self._cached_on(self._shape_cache, self._shape, device)
+
+    def _idx_max_on(self, device):
+        return self._cached_on(self._idx_max_cache, self._idx_max, device)
+
+    def _strides_on(self, device):
+        return self._cached_on(self._voxel_strides_cache, self._voxel_strides, device)
 
     @property
     def shape(self):
@@ -134,7 +307,7 @@ class VoxelMeta(AABox):
     def voxel_size(self):
         return self._voxel_size
     
-    @property
+    @cached_property
     def bins(self):
         output = tuple(
             torch.linspace(ranges[0], ranges[1], nbins)
@@ -143,7 +316,7 @@ class VoxelMeta(AABox):
 
         return output
 
-    @property
+    @cached_property
     def bin_centers(self):
         centers = tuple((b[1:] + b[:-1]) / 2. for b in self.bins)
         return centers
@@ -170,11 +343,8 @@ class VoxelMeta(AABox):
 
         idx = torch.as_tensor(idx)
 
-        if len(idx.shape) == 1:
-            idx = idx[None,:]
-
-        nx, ny = self.shape[:2]
-        vox = idx[:,0] + idx[:,1]*nx + idx[:,2]*nx*ny
+        strides = self._strides_on(idx.device)
+        vox = (self.as_int64(idx) * strides).sum(-1)
 
         return vox.squeeze()
     
@@ -193,14 +363,26 @@ class VoxelMeta(AABox):
             A list of index IDs. Shape (3) if the input is a single point. Otherwise (-1,3).
 
         '''
-        voxel = torch.as_tensor(voxel)
-        nx, ny = self.shape[:2]
+        voxel = self.as_int64(torch.as_tensor(voxel))
 
-        idx = torch.column_stack([
-            voxel % nx,
-            torch.floor_divide(voxel, nx) % ny,
-            torch.floor_divide(voxel, nx*ny)]
-            )
+        if voxel.is_cuda:
+            ext = self.cuda_ext()
+            if ext is not None:
+                idx = ext.voxel_to_idx(voxel, self._fdm_nx, self._fdm_ny)
+                return idx.squeeze()
+
+        nx, ny = int(self._shape[0]), int(self._shape[1])
+
+        voxel = voxel.reshape(-1)
+        idx = torch.empty((len(voxel), 3), dtype=voxel.dtype, device=voxel.device)
+        ix, iy, iz = idx.unbind(-1)
+
+        # two divisions written straight into the output columns (iy holds voxel//nx
+        # until the end); the remainders follow from a multiply and subtract
+        torch.div(voxel, nx, rounding_mode='floor', out=iy)
+        torch.div(iy, ny, rounding_mode='floor', out=iz)
+        torch.sub(voxel, iy, alpha=nx, out=ix)
+        iy.sub_(iz, alpha=ny)
 
         return idx.squeeze()
 
@@ -221,8 +403,8 @@ class VoxelMeta(AABox):
         '''
         idx = torch.as_tensor(idx)
 
-        voxel_size = torch.as_tensor(self.voxel_size, device=idx.device)
-        ranges = torch.as_tensor(self.ranges, device=idx.device)
+        voxel_size = self._voxel_size_on(idx.device)
+        ranges = self._ranges_on(idx.device)
         coord = (idx+0.5) * voxel_size
         coord += ranges[:, 0]
         return coord
@@ -262,18 +444,16 @@ class VoxelMeta(AABox):
         '''
         # TODO(2021-10-29 kvt) validate coord_to_idx
         # TODO(2021-10-29 kvt) check ranges
-        coord = torch.as_tensor(coord)
+        if not torch.is_tensor(coord):
+            coord = torch.as_tensor(coord, dtype=torch.float32)
 
-        step = torch.as_tensor(self.voxel_size, device=coord.device)
-        ranges = torch.as_tensor(self.ranges, device=coord.device)
-        idx = (coord - ranges[:,0]) / step
+        inv_step = self._inv_voxel_size_on(coord.device)
+        ranges = self._ranges_on(coord.device)
+        idx = (coord - ranges[:,0]) * inv_step
 
         idx = self.as_int64(idx)
-        idx[idx<0] = 0
-        for axis in range(3):
-            n = self.shape[axis]
-            mask = idx[...,axis] >= n
-            idx[mask,axis] = n-1
+        idx_max = self._idx_max_on(idx.device)
+        idx.clamp_(min=torch.zeros_like(idx_max), max=idx_max)
 
         return idx
 
@@ -291,9 +471,109 @@ class VoxelMeta(AABox):
         torch.Tensor
             An array of corresponding voxels represented as integer voxel ID
         '''
-        idx = self.coord_to_idx(coord)
-        vox = self.idx_to_voxel(idx)
-        return vox
+        if not torch.is_tensor(coord):
+            coord = torch.as_tensor(coord, dtype=torch.float32)
+        elif coord.dtype not in (torch.float32, torch.float64):
+            # promote as arithmetic with the float32 ranges would (float16 or integer input)
+            coord = coord.to(torch.float32)
+
+        if coord.is_cuda and coord.dtype == torch.float32:
+            ext = self.cuda_ext()
+            if ext is not None:
+                vox = ext.coord_to_voxel(
+                    coord.reshape(-1, 3),
+                    self._xmin,
+                    self._inv_step_f,
+                    self._n,
+                )
+                return vox.reshape(coord.shape[:-1]).squeeze()
+
+            ext = self.triton_ext()
+            if ext is not None:
+                vox = ext.coord_to_voxel(
+                    coord.reshape(-1, 3),
+                    self._xmin,
+                    self._inv_step_f,
+                    self._n,
+                )
+                return vox.reshape(coord.shape[:-1]).squeeze()
+
+        if coord.device.type == 'cpu' and coord.numel() > self._numba_min_numel:
+            ext = self.numba_ext()
+            if ext is not None:
+                coord_np = coord.detach().reshape(-1, 3).numpy()
+                vox = torch.empty(len(coord_np), dtype=torch.int64)
+                # float32 arrays (not the python float tuples) so that numba does
+                # the arithmetic in the same precision as the other paths
+                ext.coord_to_voxel_np(
+                    coord_np,
+                    self._ranges[:,0].numpy(),
+                    self._inv_voxel_size.numpy(),
+                    *self._n,
+                    vox.numpy(),
+                )
+                return vox.reshape(coord.shape[:-1]).squeeze()
+
+        vox = self._c2v(coord)
+        return vox.squeeze()
+
+
+    def coord_to_voxel_soa(self, x, y, z):
+        '''
+        Converts from the absolute coordinate to the voxel ID (1) for positions stored
+        as separate arrays per axis (structure-of-arrays). Same as coord_to_voxel but
+        preferred for large GPU batches as the kernels read each axis contiguously.
+
+        Parameters
+        ----------
+        x, y, z : array-like (1D)
+            The position components along each axis, all with the same length
+
+        Returns
+        torch.Tensor
+            An array of corresponding voxels represented as integer voxel ID
+        '''
+        x, y, z = (v if torch.is_tensor(v) else torch.as_tensor(v, dtype=torch.float32)
+                   for v in (x, y, z))
+
+        if x.is_cuda and all(v.dtype == torch.float32 and v.device == x.device for v in (x, y, z)):
+            args = (
+                self._xmin,
+                self._inv_step_f,
+                self._n,
+            )
+
+            ext = self.cuda_ext()
+            if ext is not None:
+                vox = ext.coord_to_voxel_soa(x, y, z, *args)
+                return vox.squeeze()
+
+            ext = self.triton_ext()
+            if ext is not None:
+                vox = ext.coord_to_voxel_soa(x, y, z, *args)
+                return vox.squeeze()
+
+        return self.coord_to_voxel(torch.stack((x, y, z), dim=-1))
+
+
+    def _c2v(self, coord):
+        '''
+        Torch implementation of coord_to_voxel: compiled for large batches (if torch.compile
+        works on this machine), eager otherwise
+        '''
+        if VoxelMeta._c2v_compile_ok and coord.numel() > self._compile_min_numel:
+            try:
+                if VoxelMeta._c2v_compiled is None:
+                    VoxelMeta._c2v_compiled = torch.compile(_c2v_core, dynamic=True, fullgraph=True)
+                return VoxelMeta._c2v_compiled(coord, **self._c2v_kwargs)
+            except Exception as e:
+                # re-raises right away if the input itself is at fault
+                vox = _c2v_core(coord, **self._c2v_kwargs)
+                warnings.warn(f'torch.compile failed, using eager coord_to_voxel ({e})')
+                VoxelMeta._c2v_compile_ok = False
+                return vox
+
+        return _c2v_core(coord, **self._c2v_kwargs)
 
 
     def as_int64(self, idx):
@@ -320,13 +600,9 @@ class VoxelMeta(AABox):
         else:
             raise TypeError('The argument must be a configuration dict or a filepath string')
 
-        with h5py.File(fname, 'r') as f:
-            shape = torch.as_tensor(f['numvox'][:],dtype=torch.float32)
-            ranges = torch.column_stack((
-                torch.as_tensor(f['min'],dtype=torch.float32),
-                torch.as_tensor(f['max'],dtype=torch.float32)
-                )
-            )
+        with h5py.File(fname, 'r', **_H5_READ_KWARGS) as f:
+            shape = torch.from_numpy(np.asarray(f['numvox'][()], dtype=np.int64))
+            ranges = cls._read_ranges(f)
         return cls(shape, ranges)
 
 
@@ -348,37 +624,34 @@ class VoxelMeta(AABox):
         axis, axis_others = self.select_axis(axis)
         axis_a, axis_b = axis_others
 
-        grid = [None] * 3
-        grid[axis] = i
-        grid[axis_a] = torch.arange(self.shape[axis_a])
-        grid[axis_b] = torch.arange(self.shape[axis_b])
+        pair = torch.cartesian_prod(
+            torch.arange(int(self.shape[axis_a])),
+            torch.arange(int(self.shape[axis_b])),
+        )
 
-        idx = torch.column_stack([g.flatten() for g in torch.meshgrid(*grid)])
+        idx = torch.empty((len(pair), 3), dtype=torch.int64)
+        idx[:,axis] = i
+        idx[:,axis_a] = pair[:,0]
+        idx[:,axis_b] = pair[:,1]
         return idx
     
     def check_valid_idx(self, idx, return_components=False):
         idx = torch.as_tensor(idx)
-        shape = torch.as_tensor(self.shape,device=idx.device)
-        mask = (idx >= 0) & (idx < shape)
+        shape = self._shape_on(idx.device)
 
         if return_components:
-            return mask
+            return (idx >= 0) & (idx < shape)
 
-        return torch.all(mask, axis=-1)
+        return idx.ge(0).all(-1) & idx.lt(shape).all(-1)
 
     def digitize(self, x, axis):
         x = torch.as_tensor(x)
         axis = self.select_axis(axis)[0]
-        n = self.shape[axis]
-
-        xmin = self.ranges[axis, 0]
-        step = self.voxel_size[axis]
 
-        idx = self.as_int64((x - xmin) / step)
+        idx = self.as_int64((x - self._xmin[axis]) * self._inv_step_f[axis])
 
         # TODO: (2021-10-29 kvt) exception?
-        idx[idx<0] = 0
-        idx[idx>=n] = n-1
+        idx.clamp_(0, self._n[axis]-1)
 
         return idx
 
@@ -2,7 +2,7 @@ import h5py
 import torch
 import numpy as np
 from scipy.ndimage import sobel
-from .meta import VoxelMeta
+from .meta import VoxelMeta, _H5_READ_KWARGS
 
 class PhotonLib:
     def __init__(self, meta: VoxelMeta, vis:torch.Tensor, eff:float = 1.):
@@ -45,8 +45,8 @@ class PhotonLib:
         meta = VoxelMeta.load(filepath)
         
         print(f'[PhotonLib] loading {filepath}')
-        with h5py.File(filepath, 'r') as f:
-            vis = torch.as_tensor(f['vis'][:])
+        with h5py.File(filepath, 'r', **_H5_READ_KWARGS) as f:
+            vis = torch.from_numpy(f['vis'][()])
             eff = torch.as_tensor(f.get('eff', default=1.))
         print('[PhotonLib] file loaded')
 
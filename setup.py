@@ -21,6 +21,10 @@ setup(
         'torch',
         'h5py',
     ],
+    extras_require={
+        'numba': ['numba'],
+        'triton': ['triton'],
+    },
     long_description=long_description,
     long_description_content_type='text/markdown',
 )